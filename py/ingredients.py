@@ -1,66 +1,219 @@
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+import time
+from functools import lru_cache
+
+import numpy as np
 import pandas as pd
-from scipy import stats
+from scipy import sparse
+
+from typing import Callable, Dict, Iterable, List, Optional
+
+
+try:
+    import pyarrow  # noqa: F401
+except ImportError:
+    STRING_DTYPE = 'string'
+else:
+    STRING_DTYPE = 'string[pyarrow]'
+
+YES_NO = {'yes': 1, 'no': 0}
+
+# Where computed stats tables are pickled, keyed by a hash of the input data.
+STATS_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ingredients')
+STATS_CACHE_MAX_ENTRIES = 1000
+# Seconds after which an unfinished '.tmp' cache write is assumed abandoned.
+STATS_CACHE_TMP_MAX_AGE = 600
+# Bump when the pickled format changes, to orphan old entries.
+STATS_CACHE_VERSION = 1
+
+# Hash of this module's source as imported (or reloaded), so that editing the
+# code that builds the stats tables also invalidates cached ones.
+with open(__file__, 'rb') as _f:
+    _SOURCE_HASH = hashlib.sha1(_f.read()).hexdigest()
+del _f
+
+
+# (pattern, canonical name) pairs, matched from the start of the normalized
+# ingredient string; the first pattern that matches wins.
+RENAME_RULES = [
+    (r'.*aloe', 'aloe vera'),
+    (r'.*avena sativa', 'avena sativa'),
+    (r'(?=.*capry).*lycol', 'caprylyl lycol'),
+    (r'(?=.*propylene).*lycol', 'propylene gylcol'),
+    (r'.*butyrospermum', 'shea butter'),
+    (r'.*tocopherol', 'tocopherols'),  # questionable
+    (r'.*polysorbate', 'polysorbate'),
+    (r'.*jojoba', 'jojoba'),
+    (r'.*fragrance', 'fragrance'),
+    (r'.*decyl glucoside', 'decyl glucoside'),
+    (r'ce.*alcohol', 'cetyl alcohol'),
+    (r'.*cocos nucifera', 'cocos nucifera'),
+]
+# A single anchored alternation keeps rule order as precedence and handles the
+# two-keyword and prefix rules directly. On these short strings it is as fast
+# as a keyword automaton (Aho-Corasick) that still has to resolve precedence.
+_RENAME_RE = re.compile('|'.join(f'({pattern})' for pattern, _ in RENAME_RULES),
+                        re.DOTALL)
+
+
+def normalize(ingredients: pd.Series) -> pd.Series:
+    return ingredients.str.lower().str.strip().str.strip('.')
+
+
+def _apply_rename_rules(ingredient):
+    m = _RENAME_RE.match(ingredient)
+    if m:
+        return RENAME_RULES[m.lastindex - 1][1]
+    return ingredient
 
-from typing import List, Dict
-
-
-def map_yes_no(s):
-    s = s.lower()
-    if s == 'yes':
-        return 1
-    elif s == 'no':
-        return 0
-    else:
-        raise ValueError(f"Unexpected value: {s}; need 'yes' or 'no'")
 
 def rename(ingredient):
-    s = ingredient.lower().strip().strip('.')
-    if 'aloe' in s:
-        return 'aloe vera'
-    elif 'avena sativa' in s:
-        return 'avena sativa'
-    elif 'capry' in s and 'lycol' in s:
-        return 'caprylyl lycol'
-    elif 'propylene' in s and 'lycol' in s:
-        return 'propylene gylcol'
-    elif 'butyrospermum' in s:
-        return 'shea butter'
-    elif 'tocopherol' in s:  # questionable
-        return 'tocopherols'
-    elif 'polysorbate' in s:
-        return 'polysorbate'
-    elif 'jojoba' in s:
-        return 'jojoba'
-    elif 'fragrance' in s:
-        return 'fragrance'
-    elif 'decyl glucoside' in s:
-        return 'decyl glucoside'
-    elif s.startswith('ce') and 'alcohol' in s:
-        return 'cetyl alcohol'
-    elif 'cocos nucifera' in s:
-        return 'cocos nucifera'
-    return s
+    return _rename_normalized(ingredient.lower().strip().strip('.'))
+
+
+@lru_cache(maxsize=None)
+def _rename_normalized(ingredient):
+    # ingredient must already be normalized; see normalize().
+    if ingredient in _EXACT_PASSTHROUGH:
+        return ingredient
+    return _apply_rename_rules(ingredient)
+
+
+def posterior_stats(ids: np.ndarray, hits: np.ndarray, n_keys: int):
+    # ids[k] is the key of the k-th (brand, key) pair and hits[k] that brand's
+    # allergy status. Returns posterior mean, hit count and product count per key.
+    alpha = np.bincount(ids, weights=hits, minlength=n_keys).astype(int)
+    n = np.bincount(ids, minlength=n_keys)
+    # Mean of the Beta(alpha + 1, n - alpha + 1) posterior.
+    posterior_mean = np.round((alpha + 1) / (n + 2), 2)
+    return posterior_mean, alpha, n
+
+
+def _evict_stale_stats(cache_dir: str):
+    # Keep only the STATS_CACHE_MAX_ENTRIES most recently used entries, and
+    # drop temporary files left behind by writers that died mid-write.
+    now = time.time()
+    for f in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, f)
+        if f.endswith('.tmp') and now - os.path.getmtime(path) > STATS_CACHE_TMP_MAX_AGE:
+            os.remove(path)
+    paths = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.pkl')]
+    if len(paths) > STATS_CACHE_MAX_ENTRIES:
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - STATS_CACHE_MAX_ENTRIES]:
+            os.remove(path)
+
+
+_MISSING = object()
+
+
+class _slot_cached_property:
+    # functools.cached_property for classes with __slots__: the value is kept
+    # in the slot '_cached_<name>', which the owner must declare.
+    def __init__(self, func):
+        self.func = func
+        self.slot = None
+
+    def __set_name__(self, owner, name):
+        self.slot = '_cached_' + name.lstrip('_')
+        slots = set()
+        for cls in owner.__mro__[:-1]:
+            if '__slots__' not in vars(cls):
+                return  # instances have a __dict__ to hold the value
+            cls_slots = vars(cls)['__slots__']
+            slots.update((cls_slots,) if isinstance(cls_slots, str) else cls_slots)
+        if self.slot not in slots:
+            raise TypeError(f"{owner.__name__}.__slots__ needs '{self.slot}' for {name}")
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = getattr(instance, self.slot, _MISSING)
+        if value is _MISSING:
+            value = self.func(instance)
+            setattr(instance, self.slot, value)
+        return value
 
 
 class Ingredients:
-    def __init__(self, dat):
+    # Derived attributes are cached on first access. Assigning to self.dat
+    # normalizes the new frame and clears them; after mutating self.dat in
+    # place, reassign it (ing.dat = ing.dat) to get the same effect.
+    __slots__ = ('_dat',
+                 'cache_dir',
+                 '_cached_dat_hash',
+                 '_cached_ingredient_cols',
+                 '_cached_ingredients_to_hits',
+                 '_cached_ingredient_hits',
+                 '_cached_ingredient_to_brands',
+                 '_cached_groups_to_hits',
+                 '_cached_allergy_vec',
+                 '_cached_brand_group_matrix',
+                 '_cached_brand_group_ids',
+                 '_cached_group_stats_dat',
+                 '_cached_ingredient_stats_dat',
+                 '_cached_brand_allergy_status',
+                 '_cached_unique_ingredients',
+                 '_cached_names_to_ingredients',
+                 '_cached_names_to_groups',
+                 '_cached_names_to_ingredients_and_groups')
+
+    def __init__(self, dat, cache_dir: Optional[str] = STATS_CACHE_DIR):
+        # Pass cache_dir=None to always recompute the stats tables.
+        self.cache_dir = cache_dir
         self.dat = dat
 
     @property
+    def dat(self) -> pd.DataFrame:
+        return self._dat
+
+    @dat.setter
+    def dat(self, dat: pd.DataFrame):
+        self.clear_cache()
+        self._dat = dat.copy()
+        for c in self.ingredient_cols:
+            # All-empty columns are read as floats and have nothing to normalize.
+            if self._dat[c].notna().any():
+                self._dat[c] = normalize(self._dat[c].astype(STRING_DTYPE))
+
+    def clear_cache(self):
+        # Forget every derived attribute, including the hash that keys the
+        # on-disk stats cache.
+        for cls in type(self).__mro__:
+            slots = vars(cls).get('__slots__', ())
+            for slot in (slots,) if isinstance(slots, str) else slots:
+                if slot.startswith('_cached_') and hasattr(self, slot):
+                    delattr(self, slot)
+
+    def build(self) -> 'Ingredients':
+        # Compute every derived attribute now rather than on first access.
+        # Each is still computed at most once, so later reads are slot lookups.
+        names = {name for cls in type(self).__mro__ for name, attr in vars(cls).items()
+                 if isinstance(attr, _slot_cached_property)}
+        for name in names:
+            getattr(self, name)
+        return self
+
+    @_slot_cached_property
     def ingredient_cols(self) -> List[str]:
-        return [c for c in self.dat.columns if "ingredient" in c.lower()]
+        mask = self.dat.columns.str.lower().str.contains("ingredient", regex=False)
+        return self.dat.columns[mask].tolist()
 
-    @property
+    @_slot_cached_property
     def ingredients_to_hits(self):
-        ingredients_to_hits = {}
-        for ingredient in self.unique_ingredients:
-            ingredients_to_hits[ingredient] = []
-            for brand, ingredients in self.names_to_ingredients.items():
-                if ingredient in ingredients:
-                    ingredients_to_hits[ingredient].append(self.brand_allergy_status[brand])
-        return ingredients_to_hits
+        return {ingredient: hits.tolist() for ingredient, hits
+                in self._ingredient_hits.groupby('group')['hit']}
 
-    @property
+    @_slot_cached_property
+    def _ingredient_hits(self) -> pd.DataFrame:
+        return self._get_hits_dat({brand: set(ingredients) for brand, ingredients
+                                   in self.names_to_ingredients.items()})
+
+    @_slot_cached_property
     def ingredient_to_brands(self) -> Dict[str, List[str]]:
         ingredient_to_brands = {}
         for brand, ingredients in self.names_to_ingredients.items():
@@ -71,35 +224,123 @@ class Ingredients:
         return ingredient_to_brands
 
 
-    @property
+    @_slot_cached_property
     def groups_to_hits(self):
-        groups_to_hits = {}
-        for brand, groups in self.names_to_groups.items():
+        brand_ids, group_ids = self._brand_group_ids
+        groups = np.array(list(_GROUP_INDEX), dtype=object)
+        hits = pd.Series(self._allergy_vec[brand_ids])
+        return {group: h.tolist() for group, h
+                in hits.groupby(groups[group_ids], sort=False)}
+
+    @_slot_cached_property
+    def _allergy_vec(self) -> np.ndarray:
+        # Allergy status of each brand, in names_to_groups order.
+        return np.array([self.brand_allergy_status[brand] for brand in self.names_to_groups],
+                        dtype=int)
+
+    @_slot_cached_property
+    def brand_group_matrix(self) -> sparse.csr_matrix:
+        # Entry (i, j) is 1 where the i-th brand of names_to_groups contains
+        # an ingredient of the j-th group of group_to_ingredients.
+        brand_ids, group_ids = [], []
+        for i, groups in enumerate(self.names_to_groups.values()):
             for group in groups:
-                if group not in groups_to_hits:
-                    groups_to_hits[group] = []
-                groups_to_hits[group].append(self.brand_allergy_status[brand])
-        return groups_to_hits
-
-    @property
+                brand_ids.append(i)
+                group_ids.append(_GROUP_INDEX[group])
+        shape = (len(self.names_to_groups), len(_GROUP_INDEX))
+        return sparse.coo_matrix((np.ones(len(brand_ids), dtype=int), (brand_ids, group_ids)),
+                                 shape=shape).tocsr()
+
+    @_slot_cached_property
+    def _brand_group_ids(self):
+        # Parallel (brand index, group index) arrays, one entry per group a
+        # brand contains, read straight off the CSR structure of
+        # brand_group_matrix.
+        m = self.brand_group_matrix
+        brand_ids = np.repeat(np.arange(m.shape[0], dtype=np.intp), np.diff(m.indptr))
+        return brand_ids, m.indices.astype(np.intp)
+
+    @_slot_cached_property
     def group_stats_dat(self):
-        return self._get_stats_dat(self.groups_to_hits)
+        return self._load_or_compute_stats('group_stats', self._compute_group_stats_dat)
 
-    @property
+    @_slot_cached_property
     def ingredient_stats_dat(self):
-        return self._get_stats_dat(self.ingredients_to_hits)
+        return self._load_or_compute_stats('ingredient_stats',
+                                           self._compute_ingredient_stats_dat)
+
+    def _compute_group_stats_dat(self) -> pd.DataFrame:
+        brand_ids, group_ids = self._brand_group_ids
+        return self._get_stats_dat(np.array(list(_GROUP_INDEX), dtype=object), group_ids,
+                                   self._allergy_vec[brand_ids])
+
+    def _compute_ingredient_stats_dat(self) -> pd.DataFrame:
+        ingredient_ids, ingredients = pd.factorize(self._ingredient_hits['group'])
+        return self._get_stats_dat(np.asarray(ingredients, dtype=object), ingredient_ids,
+                                   self._ingredient_hits['hit'].to_numpy())
+
+    @_slot_cached_property
+    def _dat_hash(self) -> str:
+        # Covers the data, its column names, the renaming and grouping tables,
+        # the cache format, this module's source and the pandas version, so a
+        # change to any of them invalidates old cache entries.
+        h = hashlib.sha1(pd.util.hash_pandas_object(self.dat, index=True).to_numpy())
+        h.update(repr((STATS_CACHE_VERSION, _SOURCE_HASH, pd.__version__,
+                       list(self.dat.columns), RENAME_RULES,
+                       group_to_ingredients)).encode())
+        return h.hexdigest()
+
+    def _load_or_compute_stats(self, name: str,
+                               compute: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        if self.cache_dir is None:
+            return compute()
+        path = os.path.join(self.cache_dir, f'{self._dat_hash}-{name}.pkl')
+        try:
+            with open(path, 'rb') as f:
+                stats_dat = pickle.load(f)
+        except Exception:
+            # Missing, truncated, or written by an incompatible environment.
+            stats_dat = None
+        if isinstance(stats_dat, pd.DataFrame):
+            try:
+                os.utime(path)  # mark as recently used for eviction
+            except OSError:
+                pass
+            return stats_dat
+        stats_dat = compute()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write under a temporary name and rename it into place, so readers
+            # never see a partly written file.
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(stats_dat, f)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            _evict_stale_stats(self.cache_dir)
+        except OSError:
+            pass
+        return stats_dat
+
+    def _get_hits_dat(self, names_to_keys: Dict[str, Iterable[str]]) -> pd.DataFrame:
+        # One (brand, group, hit) row per key a brand contains.
+        rows = [(brand, key, self.brand_allergy_status[brand])
+                for brand, keys in names_to_keys.items() for key in keys]
+        return pd.DataFrame(rows, columns=['brand', 'group', 'hit'])
 
     @staticmethod
-    def _get_stats_dat(keys_to_hits: Dict[str, List[int]]) -> pd.DataFrame:
-        rows = []
-        for name, hits in keys_to_hits.items():
-            n = len(hits)
-            alpha = sum(hits)
-            beta = n - alpha
-            mu = round(float(stats.beta(alpha + 1, beta + 1).mean()), 2)
-            rows.append((name, mu, alpha, n))
+    def _get_stats_dat(names: np.ndarray, ids: np.ndarray, hits: np.ndarray) -> pd.DataFrame:
+        # Keys that no brand contains are left out.
+        posterior_mean, alpha, n = posterior_stats(ids, hits, len(names))
+        present = n > 0
         return (
-            pd.DataFrame(rows, columns=['group', 'posterior_mean', 'allergy_hits', 'nproducts'])
+            pd.DataFrame({'group': names[present],
+                          'posterior_mean': posterior_mean[present],
+                          'allergy_hits': alpha[present],
+                          'nproducts': n[present]})
             .sort_values('posterior_mean', ascending=False))
 
     def write_stats_xlsx(self, outpath: str):
@@ -107,24 +348,16 @@ class Ingredients:
             self.group_stats_dat.to_excel(writer, sheet_name='group_stats')
             self.ingredient_stats_dat.to_excel(writer, sheet_name='ingredient_stats')
 
-    @property
-    def names_to_ingredients(self) -> Dict[str, List[str]]:
-        names_to_ingredients = {}
-        for _, row in self.dat.iterrows():
-            brand = row['Brand']
-            names_to_ingredients[brand] = []
-            for col in self.ingredient_cols:
-                ingredient = row[col]
-                if not pd.isnull(ingredient):
-                    names_to_ingredients[brand].append(rename(ingredient))
-        return names_to_ingredients
-
-    @property
+    @_slot_cached_property
     def brand_allergy_status(self) -> Dict[str, str]:
-        return dict(zip(self.dat['Brand'],
-                        self.dat['Symptoms?'].apply(map_yes_no)))
-
-    @property
+        s = self.dat['Symptoms?'].astype(STRING_DTYPE).str.lower()
+        status = s.map(YES_NO)
+        bad = status.isna()
+        if bad.any():
+            raise ValueError(f"Unexpected value: {s[bad].iloc[0]}; need 'yes' or 'no'")
+        return dict(zip(self.dat['Brand'].to_numpy(), status.to_numpy()))
+
+    @_slot_cached_property
     def unique_ingredients(self) -> List[str]:
         unique_ingredients = set()
         for entries in self.names_to_ingredients.values():
@@ -133,21 +366,42 @@ class Ingredients:
 
     @property
     def ingredient_to_group(self) -> Dict[str, str]:
-        ingredient_to_group = {}
-        for group, ingredients in group_to_ingredients.items():
-            for ing in ingredients:
-                if ing not in ingredient_to_group:
-                    ingredient_to_group[ing] = []
-                ingredient_to_group[ing] = group
-        return ingredient_to_group
+        return dict(_INGREDIENT_TO_GROUP)
 
-    @property
+    @_slot_cached_property
+    def names_to_ingredients(self) -> Dict[str, List[str]]:
+        return self._names_to_ingredients_and_groups[0]
+
+    @_slot_cached_property
     def names_to_groups(self):
+        return self._names_to_ingredients_and_groups[1]
+
+    @_slot_cached_property
+    def _names_to_ingredients_and_groups(self):
+        # Rename each column's distinct values once, then look cells up by
+        # category code (-1 marks a missing cell). Both maps are filled in the
+        # same pass over the rows.
+        names_to_ingredients = {}
         names_to_groups = {}
-        for name, ingredients in self.names_to_ingredients.items():
-            names_to_groups[name] = set([self.ingredient_to_group[ing]
-                                         for ing in ingredients])
-        return names_to_groups
+        brands = self.dat['Brand'].to_numpy()
+        cols = []
+        for c in self.ingredient_cols:
+            cat = self.dat[c].astype('category').cat
+            renamed = [_rename_normalized(x) for x in cat.categories]
+            groups = [_INGREDIENT_TO_GROUP.get(ing) for ing in renamed]
+            cols.append((renamed, groups, cat.codes.to_numpy()))
+        for i, brand in enumerate(brands):
+            ingredients = []
+            brand_groups = []
+            for renamed, groups, codes in cols:
+                code = codes[i]
+                if code >= 0:
+                    ingredients.append(renamed[code])
+                    if groups[code] is not None:
+                        brand_groups.append(groups[code])
+            names_to_ingredients[brand] = ingredients
+            names_to_groups[brand] = frozenset(brand_groups)
+        return names_to_ingredients, names_to_groups
 
 
 group_to_ingredients = ingredient_groups = {
@@ -496,3 +750,15 @@ group_to_ingredients = ingredient_groups = {
         "lecithin"
     ]
 }
+
+# Ingredients listed under several groups map to the last one.
+_INGREDIENT_TO_GROUP = {ing: group
+                        for group, ingredients in group_to_ingredients.items()
+                        for ing in ingredients}
+
+_GROUP_INDEX = {group: j for j, group in enumerate(group_to_ingredients)}
+
+# Grouped ingredient names that renaming leaves unchanged (e.g. 'water'); the
+# common case, so _rename_normalized() returns them without running the rules.
+_EXACT_PASSTHROUGH = frozenset(ing for ing in _INGREDIENT_TO_GROUP
+                               if _apply_rename_rules(ing) == ing)